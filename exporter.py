@@ -1,20 +1,33 @@
 import argparse
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+import gzip
 import json
 import logging
 import os
-from datetime import datetime
-from logging import info, error, debug
-from pathlib import Path
+import random
+from datetime import datetime, timezone
+import http.client
+from logging import info, warning, error, debug
 import re
+import shutil
 import sys
-from typing import Dict, List, Union
-from urllib.request import urlopen, Request
+import threading
+from typing import BinaryIO, Callable, Deque, Dict, Iterable, Iterator, List, Set, Union
 from urllib.error import URLError, HTTPError
 import urllib.parse
-import base64
+import urllib.request
+import binascii
+from collections import deque
 from time import time
 from time import sleep
 
+# orjson is optional, it parses api responses faster directly from bytes
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # (formatName, fileExtension)
 FORMATS: Dict['str', 'str'] = {
     'markdown': 'md',
@@ -35,6 +48,34 @@ LOG_LEVEL: Dict = {
 # Characters in filenames to be replaced with "_"
 FORBIDDEN_CHARS: List[str] = ["/", "#"]
 
+# How many HTTP requests can be processed at the same time
+MAX_WORKERS: int = 8
+
+# Responses with these statuses mean server is temporarily unavailable or
+# overloaded, such requests are retried with exponentially growing delay
+# (capped at RETRY_MAX_WAIT) and random jitter, so that concurrent retries
+# won't hit the server all at once again
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES: int = 5
+RETRY_BACKOFF: float = 0.5
+RETRY_MAX_WAIT: float = 30
+RETRY_JITTER: float = 0.5
+
+# How many items to request in single listing request, BookStack allows
+# up to 500 by default
+LISTING_PART_SIZE: int = 500
+
+# How many HTTP redirects can be followed for a single request
+MAX_REDIRECTS: int = 5
+
+# Size of chunks in which downloaded files are written to disk
+DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024
+
+# Saved files get remote edit timestamp as modification time, but some
+# filesystems store it rounded down (FAT has 2 second resolution), so
+# local modification time is compared with this tolerance in seconds
+MTIME_TOLERANCE: float = 2
+
 parser = argparse.ArgumentParser(description='BookStack exporter')
 parser.add_argument('-p',
                     '--path',
@@ -65,6 +106,11 @@ parser.add_argument('--rate-limit',
                     default=180,
                     help='How many api requests can be made in a minute. '
                     'Default is 180 (BookStack defaults)')
+parser.add_argument('--concurrency',
+                    type=int,
+                    default=MAX_WORKERS,
+                    help='How many api requests can be processed at the '
+                    f'same time. Default is {MAX_WORKERS}')
 parser.add_argument('-c',
                     '--forbidden-chars',
                     type=str,
@@ -107,6 +153,15 @@ parser.add_argument(
     help="Set this option to skip checking local files timestamps against "
     "remote last edit timestamps. This will cause overwriting local files,"
     " even if they seem to be already in newest version.")
+parser.add_argument(
+    '--manifest-file',
+    type=str,
+    default=None,
+    help="File for keeping remote timestamps of exported files between runs. "
+    "When set, files whose remote timestamp did not change since they were "
+    "saved are skipped without checking them on disk. Files removed by hand"
+    " will not be downloaded again, unless --force-update-files is used. "
+    "Disabled by default.")
 parser.add_argument(
     '--images',
     action='store_true',
@@ -151,8 +206,13 @@ parser.add_argument('-V',
                     default='info',
                     help='Set verbosity level.',
                     choices=LOG_LEVEL.keys())
-
-args = parser.parse_args()
+parser.add_argument('--cache-file',
+                    type=str,
+                    default=None,
+                    help='File for keeping api responses between runs. When'
+                    ' set, listings are requested conditionally (ETag/'
+                    'Last-Modified), so the server does not have to send '
+                    'unchanged data again. Disabled by default.')
 
 
 def removesuffix(text, suffix):
@@ -162,48 +222,27 @@ def removesuffix(text, suffix):
     return text
 
 
-logging.basicConfig(format='%(levelname)s :: %(message)s',
-                    level=LOG_LEVEL.get(args.log_level))
-
-formats: List[str] = args.formats
-FORBIDDEN_CHARS = args.forbidden_chars
-
-for frmt in formats:
-    if frmt not in FORMATS:
-        error("Unknown format name (NOT file extension), "
-              "check api docs for current version of your BookStack")
+def validate_args(args: argparse.Namespace):
+    """Exit with error if parsed arguments have unsupported values."""
+    if args.concurrency < 1:
+        error("Concurrency must be at least 1")
         sys.exit(1)
 
-API_PREFIX: str = f"{removesuffix(args.host, os.path.sep)}/api"
-FS_PATH: str = removesuffix(args.path, os.path.sep)
-LEVEL_CHOICE: List[str] = args.level
-for lvl in LEVEL_CHOICE:
-    if lvl not in LEVELS:
-        error(f"Level {lvl} is not supported, can be only one of {LEVELS}")
-        sys.exit(1)
-
-with open(args.token_file, 'r', encoding='utf-8') as f:
-    TOKEN: str = removesuffix(f.readline(), '\n')
+    for frmt in args.formats:
+        if frmt not in FORMATS:
+            error("Unknown format name (NOT file extension), "
+                  "check api docs for current version of your BookStack")
+            sys.exit(1)
 
-HEADERS = {
-    'Content-Type': 'application/json; charset=utf-8',
-    'Authorization': f"Token {TOKEN}",
-    'User-Agent': args.user_agent
-}
-HEADERS_NO_TOKEN = {
-    'Content-Type': 'application/json; charset=utf-8',
-    'User-Agent': args.user_agent
-}
-
-for header in args.additional_headers:
-    values = header.split(':', 1)
-    if len(values) < 2:
-        raise ValueError(f"Improper HTTP header specification: {header}")
-    HEADERS[values[0]] = values[1]
-    HEADERS_NO_TOKEN[values[0]] = values[1]
+    if args.rate_limit < 1:
+        error("Rate limit must be at least 1 request per minute")
+        sys.exit(1)
 
-SKIP_TIMESTAMPS: bool = args.force_update_files
-SKIP_BROKEN_IMAGE_LINKS: bool = args.skip_broken_image_links
+    for lvl in args.level:
+        if lvl not in LEVELS:
+            error(f"Level {lvl} is not supported, can be only one of "
+                  f"{LEVELS}")
+            sys.exit(1)
 
 
 class ApiRateLimiter:
@@ -211,43 +250,418 @@ class ApiRateLimiter:
     def __init__(self, rate_limit: int) -> None:
         self.__rate_limit = rate_limit
         info(f"API rate limit: {self.__rate_limit}/min")
-        self.__requests_times: List[float] = []
+        # times of last requests, made or scheduled, at most rate_limit
+        self.__requests_times: Deque[float] = deque()
+        self.__lock = threading.Lock()
 
     def limit_rate_request(self):
-        """Count another request and wait minimal required time if limit is reached."""
-        current_time = time()
-        self.__requests_times.append(current_time)
-        # filter out requests older than 60s ago
-        self.__requests_times = list(
-            filter(lambda x: current_time - x <= 60, self.__requests_times))
-
-        # sleep until oldest remembered request is more than 60s ago
-        if len(self.__requests_times) > self.__rate_limit:
-            wait_time = self.__requests_times[0] + 60 - current_time
+        """Count another request and wait minimal required time if limit is reached.
+
+        Safe to call from multiple threads. Time of every request is reserved
+        under lock, so that in any 60s there are at most rate_limit requests,
+        waiting for it happens outside of the lock.
+        """
+        with self.__lock:
+            current_time = time()
+            request_time = current_time
+            if len(self.__requests_times) >= self.__rate_limit:
+                # oldest remembered request must be more than 60s ago
+                request_time = max(current_time,
+                                   self.__requests_times.popleft() + 60)
+            self.__requests_times.append(request_time)
+
+        wait_time = request_time - current_time
+        if wait_time > 0:
             info(f"API Rate limit reached, waiting {round(wait_time, 2)}s")
             sleep(wait_time)
 
 
-api_rate_limiter = ApiRateLimiter(args.rate_limit)
+class HttpConnectionPool:
+    """Persistent HTTP connections, one per host in every thread.
+
+    Reusing connections saves TCP and TLS handshake on every request.
+    Proxies configured in environment (http_proxy, https_proxy, no_proxy)
+    are used the same way as urlopen does: https connections are tunneled
+    through the proxy, http requests are sent to it with absolute url.
+    """
+
+    def __init__(self) -> None:
+        self.__local = threading.local()
+        self.__proxies: Dict[str, str] = urllib.request.getproxies()
+        self.__proxy_for_host: Dict[tuple, Union[urllib.parse.SplitResult,
+                                                 None]] = {}
+
+    def __get_proxy(
+            self, scheme: str,
+            netloc: str) -> Union[urllib.parse.SplitResult, None]:
+        """Return url of proxy to use for given host, None if no proxy."""
+        if (scheme, netloc) not in self.__proxy_for_host:
+            proxy: Union[str, None] = self.__proxies.get(scheme)
+            if proxy is None or urllib.request.proxy_bypass(netloc):
+                self.__proxy_for_host[(scheme, netloc)] = None
+            else:
+                if '://' not in proxy:
+                    proxy = f"http://{proxy}"
+                self.__proxy_for_host[(scheme, netloc)] = \
+                    urllib.parse.urlsplit(proxy)
+        return self.__proxy_for_host[(scheme, netloc)]
+
+    @staticmethod
+    def __proxy_headers(
+            proxy: urllib.parse.SplitResult) -> Dict[str, str]:
+        """Return Proxy-Authorization header if proxy url has credentials."""
+        if proxy.username is None:
+            return {}
+        credentials: str = f"{urllib.parse.unquote(proxy.username)}:" \
+            f"{urllib.parse.unquote(proxy.password or '')}"
+        encoded: str = binascii.b2a_base64(credentials.encode(),
+                                           newline=False).decode()
+        return {'Proxy-Authorization': f"Basic {encoded}"}
+
+    def __get_connection(self, scheme: str,
+                         netloc: str) -> http.client.HTTPConnection:
+        connections: Dict[tuple, http.client.HTTPConnection] = \
+            self.__local.__dict__.setdefault('connections', {})
+        if (scheme, netloc) not in connections:
+            proxy = self.__get_proxy(scheme, netloc)
+            host: str = netloc if proxy is None else proxy.netloc.rpartition(
+                '@')[2]
+            if scheme == 'https':
+                connection = http.client.HTTPSConnection(host)
+                if proxy is not None:
+                    connection.set_tunnel(netloc,
+                                          headers=self.__proxy_headers(proxy))
+            elif scheme == 'http':
+                connection = http.client.HTTPConnection(host)
+            else:
+                raise URLError(f"Unsupported url scheme: {scheme}")
+            connections[(scheme, netloc)] = connection
+        return connections[(scheme, netloc)]
+
+    def __drop_connection(self, scheme: str, netloc: str):
+        connections: Dict[tuple, http.client.HTTPConnection] = \
+            self.__local.__dict__.get('connections', {})
+        connection = connections.pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+    def __request(self, scheme: str, netloc: str, target: str,
+                  headers: Dict[str, str]) -> http.client.HTTPResponse:
+        proxy = self.__get_proxy(scheme, netloc)
+        if proxy is not None and scheme == 'http':
+            # plain http proxy expects absolute url of requested resource
+            target = f"{scheme}://{netloc}{target}"
+            headers = {**headers, **self.__proxy_headers(proxy)}
+
+        # kept alive connection could have been closed by the server
+        # in the meantime, in such case try again once with new one
+        for attempt in range(2):
+            connection = self.__get_connection(scheme, netloc)
+            try:
+                connection.request('GET', target, headers=headers)
+                return connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError) as exc:
+                self.__drop_connection(scheme, netloc)
+                if attempt > 0:
+                    raise URLError(exc) from exc
+            except (OSError, http.client.HTTPException) as exc:
+                self.__drop_connection(scheme, netloc)
+                raise URLError(exc) from exc
+        raise URLError(f"Could not connect to {netloc}")
+
+    @contextmanager
+    def open(self, url: str,
+             headers: Dict[str, str]) -> Iterator[http.client.HTTPResponse]:
+        """Make GET request and yield response to read the body from.
+
+        Follows redirects and raises HTTPError/URLError just like urlopen.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            url_obj = urllib.parse.urlsplit(url)
+            target: str = url_obj.path or '/'
+            if url_obj.query:
+                target += f"?{url_obj.query}"
+
+            response = self.__request(url_obj.scheme, url_obj.netloc, target,
+                                      headers)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+
+            try:
+                yield response
+            except BaseException:
+                self.__drop_connection(url_obj.scheme, url_obj.netloc)
+                raise
+            # whole body must be read before connection can be reused
+            if not response.isclosed():
+                self.__drop_connection(url_obj.scheme, url_obj.netloc)
+            return
+        raise URLError(f"Too many redirects for {url}")
+
+    def get(self, url: str, headers: Dict[str, str]) -> bytes:
+        """Make GET request and return response body."""
+        with self.open(url, headers) as response:
+            return response.read()
+
+
+def load_json_file(file_path: Union[str, None], description: str) -> dict:
+    """Load dict saved by save_json_file, empty if file is missing.
+
+    Unreadable file is ignored with warning, it will be saved anew.
+    """
+    if file_path is None or not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+    except (OSError, ValueError) as exc:
+        warning(f"Could not read {description} {file_path}, ignoring it: "
+                f"{exc}")
+        return {}
+    if not isinstance(data, dict):
+        warning(f"Unexpected content of {description} {file_path}, "
+                "ignoring it")
+        return {}
+    return data
+
+
+def save_json_file(file_path: str, data: dict):
+    """Save data as json, through temporary file like save_bytes.
+
+    Interrupted save then leaves previous version of file untouched.
+    """
+    tmp_path: str = f"{file_path}.part"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, file_path)
+
+
+class ApiResponseCache:
+    """Api responses kept on disk between runs, for conditional requests.
+
+    If response had ETag or Last-Modified header, next request for the same
+    url is sent with If-None-Match/If-Modified-Since, so the server can reply
+    with empty 304 Not Modified and the saved body is used instead.
+    """
+
+    def __init__(self, file_path: Union[str, None]) -> None:
+        self.__file_path = file_path
+        self.__lock = threading.Lock()
+        self.__entries: Dict[str, Dict[str, str]] = load_json_file(
+            file_path, "api cache file")
+        if self.__entries:
+            info(f"Loaded {len(self.__entries)} cached api responses")
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        """Return conditional request headers for url, if it is cached."""
+        headers: Dict[str, str] = {}
+        entry = self.__entries.get(url)
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get_body(self, url: str) -> bytes:
+        return self.__entries[url]['body'].encode()
+
+    def store(self, url: str, response_headers: http.client.HTTPMessage,
+              body: bytes):
+        """Remember response body, if it can be requested conditionally."""
+        if self.__file_path is None:
+            return
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        with self.__lock:
+            if etag is None and last_modified is None:
+                self.__entries.pop(url, None)
+                return
+            self.__entries[url] = {
+                'etag': etag,
+                'last_modified': last_modified,
+                'body': body.decode()
+            }
+
+    def save(self):
+        if self.__file_path is None:
+            return
+        save_json_file(self.__file_path, self.__entries)
+
+
+class ExportManifest:
+    """Remote timestamps of files saved by previous runs, kept on disk.
+
+    File recorded with the same timestamp as its document has now does not
+    need to be checked on disk at all.
+    """
+
+    def __init__(self, file_path: Union[str, None]) -> None:
+        self.__file_path = file_path
+        self.__lock = threading.Lock()
+        self.__entries: Dict[str, float] = load_json_file(
+            file_path, "manifest file")
+        if self.__entries:
+            info(f"Loaded manifest of {len(self.__entries)} exported files")
+
+    def is_current(self, path: str, document: 'Node') -> bool:
+        """Check if file was saved with current version of document."""
+        return self.__entries.get(path) == \
+            document.get_newest_timestamp()
+
+    def is_outdated(self, path: str, document: 'Node') -> bool:
+        """Check if file was saved with other version of document."""
+        recorded: Union[float, None] = self.__entries.get(path)
+        return recorded is not None and \
+            recorded != document.get_newest_timestamp()
+
+    def record(self, path: str, document: 'Node'):
+        """Remember that file was saved with current version of document."""
+        if self.__file_path is None:
+            return
+        with self.__lock:
+            self.__entries[path] = document.get_newest_timestamp()
+
+    def save(self):
+        if self.__file_path is None:
+            return
+        save_json_file(self.__file_path, self.__entries)
+
+
+class Config:
+    """Settings of export run and objects shared by all its requests.
+
+    Built in main() from parsed arguments.
+    """
+
+    def __init__(self, args: argparse.Namespace, token: str) -> None:
+        self.args = args
+        # for skipping costly formatting of debug messages in per file checks
+        self.debug_logging: bool = logging.getLogger().isEnabledFor(
+            logging.DEBUG)
+
+        self.formats: List[str] = args.formats
+        # levels given more than once are exported only once, in given order
+        self.level_choice: List[str] = list(dict.fromkeys(args.level))
+        self.fs_path: str = removesuffix(args.path, os.path.sep)
+        self.api_prefix: str = \
+            f"{removesuffix(args.host, os.path.sep)}/api"
+        # Matches both parts of markdown image tags updated by
+        # --markdown-images: host url after "](" and part of url of scaled
+        # images, so that the data is scanned only once
+        self.markdown_image_regex = re.compile(
+            re.escape(f"]({removesuffix(args.host, '/')}".encode()) +
+            rb'|/scaled-\d+-/')
+
+        # if all entries are single characters they are replaced in one pass
+        # using translation table, otherwise all entries are replaced one by
+        # one in given order, as replacing one can change what the next ones
+        # match
+        self.forbidden_chars_table: Dict[int, str] = {}
+        self.forbidden_chars_in_order: List[str] = []
+        if all(len(chars) == 1 for chars in args.forbidden_chars):
+            self.forbidden_chars_table = str.maketrans(
+                {char: "_"
+                 for char in args.forbidden_chars})
+        else:
+            self.forbidden_chars_in_order = args.forbidden_chars
+
+        # only GET requests without body are made, so no Content-Type is
+        # needed
+        self.headers: Dict[str, str] = {
+            'Authorization': f"Token {token}",
+            'User-Agent': args.user_agent,
+            'Accept-Encoding': 'gzip'
+        }
+        self.headers_no_token: Dict[str, str] = {
+            'User-Agent': args.user_agent
+        }
+        for header in args.additional_headers:
+            values = header.split(':', 1)
+            if len(values) < 2:
+                raise ValueError(
+                    f"Improper HTTP header specification: {header}")
+            self.headers[values[0]] = values[1]
+            self.headers_no_token[values[0]] = values[1]
+
+        self.skip_timestamps: bool = args.force_update_files
+        self.skip_broken_image_links: bool = args.skip_broken_image_links
+
+        self.api_rate_limiter = ApiRateLimiter(args.rate_limit)
+        self.http_pool = HttpConnectionPool()
+        self.api_cache = ApiResponseCache(args.cache_file)
+        self.manifest = ExportManifest(args.manifest_file)
+        self.executor = ThreadPoolExecutor(max_workers=args.concurrency)
+
+
+# configuration of current run, set in main()
+config: Config
+
+
+def submit_jobs(func: Callable, jobs: Iterable[tuple]) -> List[Future]:
+    """Start running func for every tuple of arguments in jobs in workers."""
+    return [config.executor.submit(func, *job) for job in jobs]
+
+
+def wait_for_jobs(futures: List[Future]) -> list:
+    """Wait for submitted jobs and return their results in the same order.
+
+    If any of the jobs raises, or waiting is interrupted (e.g. by Ctrl-C),
+    jobs not started yet are cancelled and the exception is re-raised here.
+    """
+    try:
+        wait(futures, return_when=FIRST_EXCEPTION)
+    except BaseException:
+        # otherwise executor would still run all queued jobs before exit
+        for future in futures:
+            future.cancel()
+        raise
+    for future in futures:
+        future.cancel()
+    return [future.result() for future in futures]
+
+
+def run_concurrently(func: Callable, jobs: Iterable[tuple]) -> list:
+    """Run func for every tuple of arguments in jobs using worker threads."""
+    return wait_for_jobs(submit_jobs(func, jobs))
 
 
 class Node:
     """Clas representing any node in whole bookstack documents "tree"."""
 
+    # no per instance __dict__, there can be a lot of Nodes
+    __slots__ = ('__name', '__children', '__last_edit_timestamp',
+                 '__newest_timestamp', '__node_id', '__parent', '__path')
+
     def __init__(self, name: str, parent: Union['Node', None], node_id: int,
-                 last_edit_timestamp: datetime):
-        for char in FORBIDDEN_CHARS:
-            name = name.replace(char, "_")
+                 last_edit_timestamp: float):
+        name = name.translate(config.forbidden_chars_table)
+        for chars in config.forbidden_chars_in_order:
+            name = name.replace(chars, "_")
         self.__name: str = name
         self.__children: List['Node'] = []
 
-        self.__parent: Union['Node', None] = parent
-        if parent is not None:
-            parent.add_child(self)
-
-        self.__last_edit_timestamp: datetime = last_edit_timestamp
+        # timestamps are kept as unix epoch, for cheap float comparison
+        self.__last_edit_timestamp: float = last_edit_timestamp
+        # newest last edit timestamp of this node and all its children
+        self.__newest_timestamp: float = last_edit_timestamp
         self.__node_id = node_id
 
+        self.__parent: Union['Node', None] = None
+        self.__path: str = "."
+        if parent is not None:
+            self.set_parent(parent)
+
     @property
     def name(self) -> str:
         """Return name of this Shelf/Book/Chapter/Page."""
@@ -258,7 +672,7 @@ class Node:
         """Return parent Node or None if there isn't any."""
         return self.__parent
 
-    def changed_since(self, timestamp: datetime) -> int:
+    def changed_since(self, timestamp: float) -> int:
         """
         Check if remote version have changed after given timestamp,
         including its children
@@ -266,36 +680,70 @@ class Node:
         :return: amount of changed documents at level of this document Node
         """
         result: int = 0
-        if self.__last_edit_timestamp > timestamp:
-            result += 1
-        for child in self.__children:
-            result += child.changed_since(timestamp)
+        stack: List['Node'] = [self]
+        while stack:
+            node = stack.pop()
+            # nothing in this subtree is newer, no need to check children
+            if node.__newest_timestamp <= timestamp:
+                continue
+            if node.__last_edit_timestamp > timestamp:
+                result += 1
+            stack.extend(node.__children)
 
         return result
 
-    def get_last_edit_timestamp(self) -> datetime:
+    def changed_since_any(self, timestamp: float) -> bool:
+        """Check if this Node or any of its children changed after timestamp."""
+        return self.__newest_timestamp > timestamp
+
+    def get_last_edit_timestamp(self) -> float:
         return self.__last_edit_timestamp
 
+    def get_newest_timestamp(self) -> float:
+        """Return newest last edit timestamp of this Node and its children."""
+        return self.__newest_timestamp
+
     def set_parent(self, parent: 'Node'):
+        """Attach this Node to parent, updating cached paths of its subtree."""
         self.__parent = parent
+        self.__update_path()
         parent.add_child(self)
 
+    def __update_path(self):
+        """Compute cached path from parent, then for all children."""
+        stack: List['Node'] = [self]
+        while stack:
+            node = stack.pop()
+            if node.__parent is not None:
+                node.__path = node.__parent.get_path() + os.path.sep + \
+                    node.__parent.name
+            stack.extend(node.__children)
+
     def add_child(self, child: 'Node'):
         self.__children.append(child)
+        self.__update_newest_timestamp(child.__newest_timestamp)
+
+    def __update_newest_timestamp(self, timestamp: float):
+        """Propagate newer subtree timestamp up to the root."""
+        node: Union['Node', None] = self
+        while node is not None and node.__newest_timestamp < timestamp:
+            node.__newest_timestamp = timestamp
+            node = node.__parent
 
     def get_all_ids(self) -> List[int]:
         """Return list containing id of this node, and all child nodes."""
-        ids = [self.get_id()]
-        for child in self.__children:
-            child_ids = child.get_all_ids()
-            for id in child_ids:
-                ids.append(id)
+        ids: List[int] = []
+        stack: List['Node'] = [self]
+        while stack:
+            node = stack.pop()
+            ids.append(node.get_id())
+            # reversed, to keep the same order as depth first recursion
+            stack.extend(reversed(node.__children))
         return ids
 
     def get_path(self) -> str:
-        if self.__parent is None:
-            return "."
-        return self.__parent.get_path() + os.path.sep + self.__parent.name
+        """Return path of this Node, computed once when parent was set."""
+        return self.__path
 
     def get_id(self) -> int:
         return self.__node_id
@@ -309,8 +757,10 @@ class Node:
 
 class AttachedFile(Node):
 
+    __slots__ = ('__parent_id', '__url', '__path')
+
     def __init__(self, name: str, parent_id: int, url: str, path: str,
-                 node_id: int, last_edit_timestamp: datetime):
+                 node_id: int, last_edit_timestamp: float):
         """
         name: filename
         parent_id: uploaded_to value from api
@@ -342,74 +792,250 @@ pages: Dict[int, Node] = {}
 pages_not_in_chapter: Dict[int, Node] = {}
 attachments: Dict[int, Node] = {}
 images: Dict[int, AttachedFile] = {}
+# directories already created or checked by make_dir
+existing_dirs: Set[str] = set()
+# files which downloads were already started in this run
+planned_files: Set[str] = set()
 
 
-def api_timestamp_string_to_datetime(timestamp: str) -> datetime:
-    return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+def api_timestamp_to_epoch(timestamp: str) -> float:
+    """Parse api UTC timestamp like 2023-01-31T12:00:00.000000Z to unix epoch.
+
+    fromisoformat is much faster than strptime, epoch can be compared
+    directly with file modification times.
+    """
+    return datetime.fromisoformat(removesuffix(
+        timestamp, 'Z')).replace(tzinfo=timezone.utc).timestamp()
 
 
 def make_dir(path: str):
-    path_obj = Path(path)
-    if path_obj.exists():
+    """Create directory with parents, if not done already in this run."""
+    if path in existing_dirs:
         return
-    info(f"Creating dir {path}")
-    path_obj.mkdir(exist_ok=True, parents=True)
+    try:
+        os.makedirs(path)
+        info(f"Created dir {path}")
+    except FileExistsError:
+        pass
+    existing_dirs.add(path)
 
 
-def api_get_bytes(path: str, raw_url: bool = False, **kwargs) -> bytes:
+def api_url(path: str, raw_url: bool = False, **kwargs) -> str:
     """
-    Retrieve bytes on specific relative api path.
+    Build url of specific relative api path, kwargs are query params.
 
-    If raw_url is set to true, it will be accessed directly, without
+    If raw_url is set to true, path is used directly, without
     prefixing with base api url.
     """
-    request_path: str = f'{API_PREFIX}/{path}'
+    request_path: str = f'{config.api_prefix}/{path}'
     if raw_url:
         request_path = path
 
     if len(kwargs) > 0:
         params: str = urllib.parse.urlencode(kwargs)
         request_path += f"?{params}"
+    return request_path
+
+
+@contextmanager
+def api_open(path: str,
+             raw_url: bool = False,
+             headers: Union[Dict[str, str], None] = None,
+             **kwargs) -> Iterator[http.client.HTTPResponse]:
+    """
+    Make request on specific relative api path and yield the response.
+
+    headers are sent in addition to default ones, for raw_url and kwargs
+    see api_url. Requests failing with one of RETRY_STATUSES are retried.
+    """
+    request_path: str = api_url(path, raw_url, **kwargs)
 
     debug(f"Making http request: {request_path}")
 
-    request: Request = Request(request_path, headers=HEADERS)
+    for attempt in range(MAX_RETRIES + 1):
+        config.api_rate_limiter.limit_rate_request()
+        with ExitStack() as stack:
+            try:
+                response = stack.enter_context(
+                    config.http_pool.open(request_path, {
+                        **config.headers,
+                        **(headers or {})
+                    }))
+            except HTTPError as exc:
+                if exc.code in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    wait_time = retry_wait_time(exc, attempt)
+                    info(f"Got {exc.code} for {request_path}, retrying in "
+                         f"{round(wait_time, 2)}s")
+                    sleep(wait_time)
+                    continue
+                if exc.code == 403 and not raw_url:
+                    error("403 Forbidden, check your token!")
+                    sys.exit(exc.code)
+                raise
+            yield response
+            return
+
+
+def retry_wait_time(exc: HTTPError, attempt: int) -> float:
+    """Return how long to wait before retrying failed request.
+
+    Retry-After header is respected if server sent it in seconds.
+    """
+    retry_after = exc.headers.get('Retry-After') if exc.headers else None
+    if retry_after is not None and retry_after.strip().isdigit():
+        return float(retry_after)
+    return min(RETRY_MAX_WAIT, RETRY_BACKOFF * 2**attempt) + \
+        random.uniform(0, RETRY_JITTER)
+
+
+def decoded_stream(response: http.client.HTTPResponse) -> BinaryIO:
+    """Return stream of response body, decompressed if it was gzipped."""
+    if response.getheader('Content-Encoding') == 'gzip':
+        return gzip.GzipFile(fileobj=response)
+    return response
 
-    api_rate_limiter.limit_rate_request()
-    with urlopen(request) as response:
-        if response.status == 403:
-            error("403 Forbidden, check your token!")
-            sys.exit(response.status)
 
-        return response.read()
+def api_get_bytes(path: str,
+                  raw_url: bool = False,
+                  cache: bool = False,
+                  **kwargs) -> bytes:
+    """Retrieve bytes on specific relative api path, see api_open.
+
+    If cache is set, request is conditional and response is kept in
+    api_cache, use it only for small responses.
+    """
+    if not cache:
+        with api_open(path, raw_url, **kwargs) as response:
+            return decoded_stream(response).read()
+
+    url: str = api_url(path, raw_url, **kwargs)
+    with api_open(path,
+                  raw_url,
+                  headers=config.api_cache.request_headers(url),
+                  **kwargs) as response:
+        data: bytes = decoded_stream(response).read()
+        if response.status == 304:
+            debug(f"Not modified, using cached response for {url}")
+            return config.api_cache.get_body(url)
+        config.api_cache.store(url, response.headers, data)
+        return data
+
+
+@contextmanager
+def open_part_file(file_path: str) -> Iterator[BinaryIO]:
+    """Open temporary file, which replaces file_path once fully written.
+
+    If writing fails or is interrupted, temporary file is removed, so that
+    no partial files are left in export directory.
+    """
+    tmp_path: str = f"{file_path}.part"
+    try:
+        with open(tmp_path, 'wb') as file:
+            yield file
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp_path, file_path)
+
+
+def save_stream(stream: BinaryIO, file_path: str):
+    """Write data read from stream to file.
+
+    Data is copied in chunks, so large files are never held in memory
+    whole. Temporary file is used until all data is written, so that
+    interrupted download won't leave partial file looking up to date.
+    """
+    with open_part_file(file_path) as file:
+        shutil.copyfileobj(stream, file, DOWNLOAD_CHUNK_SIZE)
+        # http.client returns short data instead of raising, when connection
+        # is closed before whole body is received in chunked reads
+        missing: Union[int, None] = getattr(stream, 'length', None)
+        if missing:
+            raise http.client.IncompleteRead(b'', missing)
+
+
+def save_bytes(data: bytes, file_path: str):
+    """Write data to file like save_stream, unless file already has it.
+
+    Data already in memory is cheap to compare, identical file is then not
+    written again, only its modification time gets updated by mark_saved.
+    """
+    try:
+        if os.stat(file_path).st_size == len(data):
+            with open(file_path, 'rb') as file:
+                if file.read() == data:
+                    debug(f"Content of {file_path} did not change, "
+                          "keeping old file")
+                    return
+    except FileNotFoundError:
+        pass
+
+    with open_part_file(file_path) as file:
+        file.write(data)
+
+
+def api_download(path: str, file_path: str, raw_url: bool = False, **kwargs):
+    """Stream response body on specific relative api path to file."""
+    with api_open(path, raw_url, **kwargs) as response:
+        save_stream(decoded_stream(response), file_path)
 
 
 def api_get_dict(path: str) -> dict:
     """Make api request at specified path and return result as dict."""
-    data = api_get_bytes(path).decode()
-    return json.loads(data)
+    return json_loads(api_get_bytes(path, cache=True))
 
 
-def api_get_listing(path: str) -> list:
-    """Retrieve whole lists through api.
+def api_get_listing_part(path: str, count: int, offset: int) -> dict:
+    """Retrieve single part of a list through api."""
+    return json_loads(
+        api_get_bytes(path, cache=True, count=count, offset=offset))
 
-    Request for another 50 until have collected "total" amount.
-    :param path:
-    :return:
-    """
-    count: int = 50
-    total: int = count
 
-    result: list = []
+def iter_listing_parts(path: str, first_part: dict,
+                       futures: List[Future]) -> Iterator[dict]:
+    """Yield items of already received first part, then of next parts."""
+    try:
+        yield from first_part['data']
+        for future in futures:
+            yield from future.result()['data']
+    finally:
+        for future in futures:
+            future.cancel()
 
-    while total > len(result):
-        data: dict = json.loads(
-            api_get_bytes(path, count=count, offset=len(result)))
-        total = data['total']
-        result += data['data']
+    debug(f"API listing got all {first_part['total']} items of {path}")
 
-        debug(f"API listing got {len(result)} items out of maximum {count}")
 
+def api_iter_listings(paths: List[str],
+                      pending: List[Future]) -> List[Iterator[dict]]:
+    """Retrieve multiple whole lists through api concurrently.
+
+    First part of every list is requested to learn "total" amounts, then
+    all remaining parts of all lists are requested concurrently.
+    Returned iterators yield items as soon as their part is received, so
+    they can be processed while next parts are downloaded.
+    :param paths:
+    :param pending: every submitted part request is appended here, so the
+        caller can cancel them if it stops before consuming the iterators
+    :return: iterator over items for every path, in the same order
+    """
+    count: int = LISTING_PART_SIZE
+
+    first_parts: List[dict] = run_concurrently(
+        api_get_listing_part, [(path, count, 0) for path in paths])
+
+    result: List[Iterator[dict]] = []
+    for path, first_part in zip(paths, first_parts):
+        # server can be configured to return less items than requested
+        step: int = len(first_part['data']) or count
+        futures: List[Future] = [
+            config.executor.submit(api_get_listing_part, path, step, offset)
+            for offset in range(step, first_part['total'], step)
+        ]
+        pending.extend(futures)
+        result.append(iter_listing_parts(path, first_part, futures))
     return result
 
 
@@ -418,38 +1044,75 @@ def image_translate_path(img_path: str) -> str:
 
     img_path: image 'path' attribute from api
     """
-    return f"{FS_PATH}{os.path.sep}{args.images_dir}{img_path}"
+    return f"{config.fs_path}{os.path.sep}{config.args.images_dir}{img_path}"
 
 
 def check_if_update_needed(file_path: str, document: Node) -> bool:
     """Check if a Node need updating on disk, according to timestamps."""
-    if SKIP_TIMESTAMPS:
+    if config.skip_timestamps:
+        return True
+    if config.manifest.is_current(file_path, document):
+        debug(f"Document \"{file_path}\" is recorded in manifest as up to "
+              "date, skipping updating.")
+        return False
+    # exact timestamp from manifest is more reliable than local file
+    # modification time, which is compared with MTIME_TOLERANCE
+    if config.manifest.is_outdated(file_path, document):
+        info(f"Document \"{file_path}\" changed since it was recorded in "
+             "manifest, update needed.")
         return True
     debug(f"Checking for update for file {file_path}")
 
-    if not os.path.exists(file_path):
+    # single stat call both checks existence and gets modification time
+    try:
+        local_mtime: float = os.stat(file_path).st_mtime
+    except FileNotFoundError:
         debug(f"Document {file_path} is missing on disk, update needed.")
         return True
-    local_last_edit: datetime = datetime.fromtimestamp(
-        os.path.getmtime(file_path))
-    remote_last_edit: datetime = document.get_last_edit_timestamp()
-
-    debug("Local file creation timestamp: "
-          f"{local_last_edit.date()} {local_last_edit.time()}, "
-          "remote edit timestamp:  "
-          f"{remote_last_edit.date()} {remote_last_edit.time()}")
-    changes: int = document.changed_since(local_last_edit)
 
-    if changes > 0:
+    if config.debug_logging:
+        remote_last_edit: float = document.get_last_edit_timestamp()
+        debug("Local file creation timestamp: "
+              f"{datetime.fromtimestamp(local_mtime)}, "
+              "remote edit timestamp:  "
+              f"{datetime.fromtimestamp(remote_last_edit)}")
+    if document.changed_since_any(local_mtime + MTIME_TOLERANCE):
+        changes: int = document.changed_since(local_mtime + MTIME_TOLERANCE)
         info(f"Document \"{file_path}\" consists of {changes} "
              "outdated documents, update needed.")
         return True
 
-    debug(f"Document \"{file_path}\" consists of {changes} "
+    debug(f"Document \"{file_path}\" consists of 0 "
           "outdated documents, skipping updating.")
     return False
 
 
+def plan_file(file_path: str, document: Node) -> bool:
+    """Check if file should be downloaded, planning it if so.
+
+    Downloads of all export levels run at the same time, so each file is
+    planned only once, to never have two jobs writing the same file.
+    """
+    if file_path in planned_files:
+        return False
+    if not check_if_update_needed(file_path, document):
+        return False
+    planned_files.add(file_path)
+    return True
+
+
+def mark_saved(file_path: str, document: Node):
+    """Set modification time of saved file to remote edit timestamp.
+
+    File is then up to date until the document changes, no matter how long
+    the download took or how local and server clocks differ. Coarse
+    filesystem timestamps are handled by MTIME_TOLERANCE.
+    """
+    timestamp: float = document.get_newest_timestamp()
+    os.utime(file_path, (timestamp, timestamp))
+    config.manifest.record(file_path, document)
+
+
 def update_markdown_image_tags(doc: Node, data: bytes) -> bytes:
     """Update all image tags to point to exported images in given markdown data."""
     levels = doc.parents_levels()
@@ -457,246 +1120,367 @@ def update_markdown_image_tags(doc: Node, data: bytes) -> bytes:
     # try preventing replacing host url in other paces
     dir_fallback = ']('
     dir_fallback += '../' * levels
+    dir_fallback += config.args.images_dir
+    dir_fallback_bytes = dir_fallback.encode()
+
+    def replace(match: re.Match) -> bytes:
+        # scaled image urls are replaced with "/" to use original image
+        if match.group(0).startswith(b']('):
+            return dir_fallback_bytes
+        return b'/'
+
+    return config.markdown_image_regex.sub(replace, data)
+
 
-    host = removesuffix(args.host, '/')
-    dir_fallback += args.images_dir
-    data = data.replace(f']({host}'.encode(), dir_fallback.encode())
-    data_str = re.sub(r'/scaled-\d+-/', r'/', data.decode())
-    return data_str.encode()
+def export_doc_file(document: Node, level: str, v_format: str, path: str):
+    """Download single document in given format and save it to path."""
+    export_path: str = f'{level}/{document.get_id()}/export/{v_format}'
+    if config.args.markdown_images and v_format == 'markdown':
+        # image tags need updating, so whole document has to be loaded
+        data: bytes = api_get_bytes(export_path)
+        data = update_markdown_image_tags(document, data)
+        info(f"Saving {path}")
+        save_bytes(data, path)
+    else:
+        info(f"Saving {path}")
+        api_download(export_path, path)
 
+    mark_saved(path, document)
 
-def export_doc(documents: List[Node], level: str):
-    """Save document-like Nodes to files."""
+
+def export_doc(documents: List[Node], level: str) -> List[Future]:
+    """Start saving document-like Nodes to files.
+
+    Documents needing update are downloaded concurrently, one job
+    per document format.
+    :return: futures of started downloads
+    """
+    extensions: List[tuple] = [(v_format, FORMATS[v_format])
+                               for v_format in config.formats]
+    jobs: List[tuple] = []
     for document in documents:
-        make_dir(f"{FS_PATH}{os.path.sep}{document.get_path()}")
+        doc_dir: str = f"{config.fs_path}{os.path.sep}{document.get_path()}"
+        make_dir(doc_dir)
+        # path without extension
+        doc_path: str = f"{doc_dir}{os.path.sep}{document.name}"
 
-        for v_format in formats:
-            path: str = f"{FS_PATH}{os.path.sep}{document.get_path()}" + \
-                f"{os.path.sep}{document.name}.{FORMATS[v_format]}"
+        for v_format, extension in extensions:
+            path: str = f"{doc_path}.{extension}"
 
-            if not check_if_update_needed(path, document):
+            if not plan_file(path, document):
                 continue
 
-            data: bytes = api_get_bytes(
-                f'{level}/{document.get_id()}/export/{v_format}')
-            if args.markdown_images and v_format == 'markdown':
-                data = update_markdown_image_tags(document, data)
+            jobs.append((document, level, v_format, path))
+
+    return submit_jobs(export_doc_file, jobs)
 
-            with open(path, 'wb') as file:
-                info(f"Saving {path}")
-                file.write(data)
 
+def export_attachment_file(attachment: Node, path: str):
+    """Download single attachment and save it to path."""
+    data = api_get_bytes(f'attachments/{attachment.get_id()}')
+    data = json_loads(data)
+    content = data['content']
+    content_url = urllib.parse.urlparse(content)
+
+    if content_url.scheme:
+        if config.args.dont_export_external_attachments:
+            return
+        info(f"Downloading attachment from url: {content_url.geturl()}")
+        if content_url.scheme in ('http', 'https'):
+            opened = config.http_pool.open(content_url.geturl(),
+                                           config.headers_no_token)
+        else:
+            # links can use other schemes (e.g. ftp), which only urlopen
+            # supports
+            opened = urllib.request.urlopen(
+                urllib.request.Request(content_url.geturl(),
+                                       headers=config.headers_no_token))
+        with opened as response:
+            # responses for non-http urls have no status code
+            status = response.getcode()
+            if status is not None and status >= 300:
+                error("Could not download link-type attachment from "
+                      f"'{content_url.geturl()}, got code {status}'!")
+                sys.exit(status)
+
+            info(f"Saving {path}")
+            save_stream(response, path)
+    else:
+        info(f"Saving {path}")
+        save_bytes(binascii.a2b_base64(content), path)
 
-def export_attachments(attachments: List[Node]):
-    """Save attachment Nodes to files."""
+    mark_saved(path, attachment)
+
+
+def export_attachments(attachments: List[Node]) -> List[Future]:
+    """Start saving attachment Nodes to files.
+
+    :return: futures of started downloads
+    """
+    jobs: List[tuple] = []
     for attachment in attachments:
 
         base_path = attachment.get_path()
         if attachment.parent is None:
             base_path = f'__ATTACHMENTS_FROM_DELETED_PAGES__{os.path.sep}{base_path}'
 
-        make_dir(f"{FS_PATH}{os.path.sep}{base_path}")
+        make_dir(f"{config.fs_path}{os.path.sep}{base_path}")
 
-        path: str = f"{FS_PATH}{os.path.sep}{base_path}" + \
+        path: str = f"{config.fs_path}{os.path.sep}{base_path}" + \
             f"{os.path.sep}{attachment.name}"
 
-        if not check_if_update_needed(path, attachment):
+        if not plan_file(path, attachment):
             continue
 
-        data = api_get_bytes(f'attachments/{attachment.get_id()}')
-        data = json.loads(data)
-        content = data['content']
-        content_url = urllib.parse.urlparse(content)
+        jobs.append((attachment, path))
 
-        if content_url.scheme:
-            if args.dont_export_external_attachments:
-                continue
-            info(f"Downloading attachment from url: {content_url.geturl()}")
-            request: Request = Request(content_url.geturl(),
-                                       headers=HEADERS_NO_TOKEN)
-
-            with urlopen(request) as response:
-                if response.status >= 300:
-                    error(
-                        "Could not download link-type attachment from "
-                        f"'{content_url.geturl()}, got code {response.status}'!"
-                    )
-                    sys.exit(response.status)
-
-                with open(path, 'wb') as file:
-                    info(f"Saving {path}")
-                    file.write(response.read())
+    return submit_jobs(export_attachment_file, jobs)
+
+
+def export_image_file(img: AttachedFile, path: str):
+    """Download single image and save it to path."""
+    try:
+        info(f"Saving {path}")
+        api_download(img.get_url(), path, raw_url=True)
+    except (URLError, http.client.HTTPException) as exc:
+        error(f"Failed downloading image '{img.get_url()}': {exc}")
+        if not config.skip_broken_image_links:
+            sys.exit(1)
         else:
-            with open(path, 'wb') as file:
-                info(f"Saving {path}")
-                file.write(base64.b64decode(content))
+            return
+
+    mark_saved(path, img)
+
 
+def export_images() -> List[Future]:
+    """Start saving images to files.
 
-def export_images():
+    :return: futures of started downloads
+    """
+    jobs: List[tuple] = []
     for img in images.values():
         path = image_translate_path(img.get_path())
         img_dir = os.path.dirname(path)
         make_dir(img_dir)
 
-        if not check_if_update_needed(path, img):
+        if not plan_file(path, img):
             continue
 
-        try:
-            data: bytes = api_get_bytes(img.get_url(), raw_url=True)
-        except (URLError, HTTPError) as exc:
-            error(f"Failed downloading image '{img.get_url()}': {exc}")
-            if not SKIP_BROKEN_IMAGE_LINKS:
-                sys.exit(1)
-            else:
-                continue
-        with open(path, 'wb') as file:
-            info(f"Saving {path}")
-            file.write(data)
+        jobs.append((img, path))
+
+    return submit_jobs(export_image_file, jobs)
 
 
 #########################
 # Gathering data from api
 #########################
 
-info("Getting info about Shelves and their Books")
 
-for shelf_data in api_get_listing('shelves'):
-
-    last_edit_ts: datetime = api_timestamp_string_to_datetime(
-        shelf_data['updated_at'])
-    shelf = Node(shelf_data.get('name'), None, shelf_data.get('id'),
-                 last_edit_ts)
+def gather_nodes():
+    """Request api listings and build tree of Nodes to be exported."""
+    info("Requesting api listings")
+
+    # listings do not depend on each other, fetch them all at once
+    listing_paths: List[str] = ['shelves', 'books', 'chapters', 'pages']
+    if not config.args.dont_export_attachments:
+        listing_paths.append('attachments')
+    if config.args.images or config.args.markdown_images:
+        listing_paths.append('image-gallery')
+    pending: List[Future] = []
+    try:
+        build_nodes(dict(
+            zip(listing_paths, api_iter_listings(listing_paths, pending))))
+    except BaseException:
+        # parts of listings not consumed yet would still be downloaded
+        # by the executor before exit
+        for future in pending:
+            future.cancel()
+        raise
+
+
+def build_nodes(listings: Dict[str, Iterator[dict]]):
+    """Build tree of Nodes from api listings and details of their items."""
+    info("Getting info about Shelves and their Books")
+
+    shelves_data: list = list(listings['shelves'])
+    # details of all shelves are independent, fetch them concurrently,
+    # but build the Nodes here in order
+    shelves_details: list = run_concurrently(
+        api_get_dict, [(f"shelves/{shelf_data.get('id')}", )
+                       for shelf_data in shelves_data])
+
+    for shelf_data, shelf_details in zip(shelves_data, shelves_details):
+
+        last_edit_ts: float = api_timestamp_to_epoch(
+            shelf_data['updated_at'])
+        shelf = Node(shelf_data.get('name'), None, shelf_data.get('id'),
+                     last_edit_ts)
+
+        debug(f"Shelf: \"{shelf.name}\", ID: {shelf.get_id()}")
+        shelves[shelf.get_id()] = shelf
+
+        if shelf_details.get('books') is None:
+            continue
+        for book_data in shelf_details['books']:
 
-    debug(f"Shelf: \"{shelf.name}\", ID: {shelf.get_id()}")
-    shelves[shelf.get_id()] = shelf
+            last_edit_ts: float = api_timestamp_to_epoch(
+                book_data['updated_at'])
+            book = Node(book_data.get('name'), shelf, book_data.get('id'),
+                        last_edit_ts)
+            debug(f"Book: \"{book.name}\", ID: {book.get_id()}")
+            books[book.get_id()] = book
 
-    shelf_details = api_get_dict(f'shelves/{shelf.get_id()}')
+    info("Getting info about Books not belonging to any shelf")
 
-    if shelf_details.get('books') is None:
-        continue
-    for book_data in shelf_details['books']:
+    for book_data in listings['books']:
+        if book_data.get('id') in books:
+            continue
 
-        last_edit_ts: datetime = api_timestamp_string_to_datetime(
+        last_edit_ts: float = api_timestamp_to_epoch(
             book_data['updated_at'])
-        book = Node(book_data.get('name'), shelf, book_data.get('id'),
+        book = Node(book_data.get('name'), None, book_data.get('id'),
                     last_edit_ts)
-        debug(f"Book: \"{book.name}\", ID: {book.get_id()}")
+
+        debug(f"Book: \"{book.name}\", ID: {book.get_id()}, "
+              f"last edit: {book_data['updated_at']}")
+        info(f"Book \"{book.name} has no shelf assigned.\"")
         books[book.get_id()] = book
 
-info("Getting info about Books not belonging to any shelf")
+    info("Getting info about Chapters")
 
-for book_data in api_get_listing('books'):
-    if book_data.get('id') in books:
-        continue
+    for chapter_data in listings['chapters']:
+        last_edit_ts: float = api_timestamp_to_epoch(
+            chapter_data['updated_at'])
+        chapter = Node(chapter_data.get('name'),
+                       books.get(chapter_data.get('book_id')),
+                       chapter_data.get('id'), last_edit_ts)
+        debug(f"Chapter: \"{chapter.name}\", ID: {chapter.get_id()},"
+              f" last edit: {chapter_data['updated_at']}")
+        chapters[chapter.get_id()] = chapter
 
-    last_edit_ts: datetime = api_timestamp_string_to_datetime(
-        book_data['updated_at'])
-    book = Node(book_data.get('name'), None, book_data.get('id'), last_edit_ts)
+    info("Getting info about Pages")
 
-    debug(f"Book: \"{book.name}\", ID: {book.get_id()}, "
-          f"last edit: {book.get_last_edit_timestamp()}")
-    info(f"Book \"{book.name} has no shelf assigned.\"")
-    books[book.get_id()] = book
+    for page_data in listings['pages']:
+        parent_id = page_data.get('chapter_id')
 
-info("Getting info about Chapters")
+        last_edit_ts: float = api_timestamp_to_epoch(
+            page_data['updated_at'])
 
-for chapter_data in api_get_listing('chapters'):
-    last_edit_ts: datetime = api_timestamp_string_to_datetime(
-        chapter_data['updated_at'])
-    chapter = Node(chapter_data.get('name'),
-                   books.get(chapter_data.get('book_id')),
-                   chapter_data.get('id'), last_edit_ts)
-    debug(f"Chapter: \"{chapter.name}\", ID: {chapter.get_id()},"
-          f" last edit: {chapter.get_last_edit_timestamp()}")
-    chapters[chapter.get_id()] = chapter
+        chapter: Union[Node, None] = chapters.get(parent_id)
 
-info("Getting info about Pages")
+        if chapter is None:
+            parent = books[page_data['book_id']]
+            page = Node(page_data.get('name'), parent, page_data.get('id'),
+                        last_edit_ts)
 
-for page_data in api_get_listing('pages'):
-    parent_id = page_data.get('chapter_id')
+            info(f"Page \"{page.name}\" is not in any chapter, "
+                 f"using Book \"{parent.name}\" as a parent.")
 
-    last_edit_ts: datetime = api_timestamp_string_to_datetime(
-        page_data['updated_at'])
+            debug(f"Page: \"{page.name}\", ID: {page.get_id()},"
+                  f" last edit: {page_data['updated_at']}")
+            pages[page.get_id()] = page
+            pages_not_in_chapter[page.get_id()] = page
+            continue
 
-    if parent_id not in chapters:
-        parent = books[page_data['book_id']]
-        page = Node(page_data.get('name'), parent, page_data.get('id'),
+        page = Node(page_data.get('name'), chapter, page_data.get('id'),
                     last_edit_ts)
+        debug(f"Page: \"{page.name}\", ID: {page.get_id()}, "
+              f"last edit: {page_data['updated_at']}")
+        pages[page.get_id()] = page
 
-        info(f"Page \"{page.name}\" is not in any chapter, "
-             f"using Book \"{parent.name}\" as a parent.")
+    if not config.args.dont_export_attachments:
+        info("Getting info about Attachments.")
+
+        for attachment_data in listings['attachments']:
+            last_edit_ts: float = api_timestamp_to_epoch(
+                attachment_data['updated_at'])
+            # pages_not_in_chapter are also in pages, no need to merge them
+            attachment = Node(attachment_data.get('name'),
+                              pages.get(attachment_data.get('uploaded_to')),
+                              attachment_data.get('id'), last_edit_ts)
+            debug(f"Attachment: \"{attachment.name}\", "
+                  f"ID: {attachment.get_id()}, "
+                  f"last edit: {attachment_data['updated_at']}")
+            attachments[attachment.get_id()] = attachment
+
+    if config.args.images or config.args.markdown_images:
+        info("Getting info about Image gallery.")
+
+        for image_data in listings['image-gallery']:
+            last_edit_ts: float = api_timestamp_to_epoch(
+                image_data['updated_at'])
+            image = AttachedFile(name=image_data.get('name'),
+                                 parent_id=image_data.get('uploaded_to'),
+                                 url=image_data.get('url'),
+                                 path=image_data.get('path'),
+                                 node_id=image_data.get('id'),
+                                 last_edit_timestamp=last_edit_ts)
+            debug(f"Image: \"{image.name}\", ID: {image.get_id()},"
+                  f" last edit: {image_data['updated_at']}")
+            images[image.get_id()] = image
 
-        debug(f"Page: \"{page.name}\", ID: {page.get_id()},"
-              f" last edit: {page.get_last_edit_timestamp()}")
-        pages[page.get_id()] = page
-        pages_not_in_chapter[page.get_id()] = page
-        continue
-
-    page = Node(page_data.get('name'), chapters.get(parent_id),
-                page_data.get('id'), last_edit_ts)
-    debug(f"Page: \"{page.name}\", ID: {page.get_id()}, "
-          f"last edit: {page.get_last_edit_timestamp()}")
-    pages[page.get_id()] = page
-
-if not args.dont_export_attachments:
-    info("Getting info about Attachments.")
-
-    for attachment_data in api_get_listing('attachments'):
-        last_edit_ts: datetime = api_timestamp_string_to_datetime(
-            attachment_data['updated_at'])
-        all_pages = {}
-        all_pages.update(pages)
-        all_pages.update(pages_not_in_chapter)
-        attachment = Node(attachment_data.get('name'),
-                          all_pages.get(attachment_data.get('uploaded_to')),
-                          attachment_data.get('id'), last_edit_ts)
-        debug(f"Attachment: \"{attachment.name}\", ID: {attachment.get_id()},"
-              f" last edit: {attachment.get_last_edit_timestamp()}")
-        attachments[attachment.get_id()] = attachment
-
-if args.images or args.markdown_images:
-    info("Getting info about Image gallery.")
-
-    for image_data in api_get_listing('image-gallery'):
-        last_edit_ts: datetime = api_timestamp_string_to_datetime(
-            image_data['updated_at'])
-        image = AttachedFile(name=image_data.get('name'),
-                             parent_id=image_data.get('uploaded_to'),
-                             url=image_data.get('url'),
-                             path=image_data.get('path'),
-                             node_id=image_data.get('id'),
-                             last_edit_timestamp=last_edit_ts)
-        debug(f"Image: \"{image.name}\", ID: {image.get_id()},"
-              f" last edit: {image.get_last_edit_timestamp()}")
-        images[image.get_id()] = image
 
 #########################
 # Exporting data from api
 #########################
 
-files: List[Node] = []
-EXPORT_PAGES_NOT_IN_CHAPTER: bool = False
 
-for lvl in LEVEL_CHOICE:
-    if lvl == 'pages':
-        files = list(pages.values())
-    elif lvl == 'chapters':
-        files = list(chapters.values())
-        EXPORT_PAGES_NOT_IN_CHAPTER = True
-    elif lvl == 'books':
-        files = list(books.values())
+def start_exports() -> List[Future]:
+    """Start saving all gathered Nodes to files.
+
+    :return: futures of started downloads
+    """
+    # downloads of all levels are started before waiting for any of them, so
+    # that workers don't idle between levels
+    downloads: List[Future] = []
+    level_documents: Dict[str, Dict[int, Node]] = {
+        'pages': pages,
+        'chapters': chapters,
+        'books': books
+    }
+    # pages outside of chapters are not covered by chapters level, unless
+    # pages level already exports all of them
+    export_pages_not_in_chapter: bool = \
+        'chapters' in config.level_choice \
+        and 'pages' not in config.level_choice
+
+    for lvl in config.level_choice:
+        downloads += export_doc(list(level_documents[lvl].values()), lvl)
+
+    if export_pages_not_in_chapter:
+        info("Exporting pages that are not in chapter...")
+        downloads += export_doc(list(pages_not_in_chapter.values()), 'pages')
+
+    if not config.args.dont_export_attachments:
+        downloads += export_attachments(list(attachments.values()))
+
+    if config.args.images or config.args.markdown_images:
+        downloads += export_images()
+
+    return downloads
+
+
+def main():
+    global config
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s :: %(message)s',
+                        level=LOG_LEVEL.get(args.log_level))
+    validate_args(args)
+
+    with open(args.token_file, 'r', encoding='utf-8') as f:
+        token: str = removesuffix(f.readline(), '\n')
+
+    config = Config(args, token)
 
-    export_doc(files, lvl)
+    gather_nodes()
+    wait_for_jobs(start_exports())
 
-if EXPORT_PAGES_NOT_IN_CHAPTER:
-    info("Exporting pages that are not in chapter...")
-    export_doc(list(pages_not_in_chapter.values()), 'pages')
+    config.api_cache.save()
+    config.manifest.save()
 
-if not args.dont_export_attachments:
-    export_attachments(list(attachments.values()))
+    info("Finished")
 
-if args.images or args.markdown_images:
-    export_images()
 
-info("Finished")
-sys.exit(0)
+if __name__ == '__main__':
+    main()